@@ -1,18 +1,49 @@
 import json
+import logging
 import os
+import random
 import boto3
-import uuid
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import time
 from datetime import datetime
 import urllib.parse
+from html import escape
+from concurrent.futures import ThreadPoolExecutor
 
 # ==========================================
 # AWS CLIENT INITIALIZATION
 # ==========================================
+# Shared client settings:
+# - turn on TCP keep-alive probes so idle pooled connections are not
+#   silently dropped between warm invocations
+# - adaptive retries back off on the client side when AWS throttles requests
+# - enough pooled connections for the concurrent Textract calls in a batch
+BOTO_CONFIG = Config(
+    tcp_keepalive=True,
+    retries={'mode': 'adaptive', 'max_attempts': 5},
+    max_pool_connections=10,
+    connect_timeout=2,
+    read_timeout=30
+)
+
+# AnalyzeExpense can legitimately take longer than 30 seconds, and every
+# timed-out attempt is sent (and billed) again, so Textract keeps the default
+# read timeout and only a few attempts; adaptive mode still slows the request
+# rate when the batch's concurrent calls are throttled
+TEXTRACT_CONFIG = Config(
+    tcp_keepalive=True,
+    retries={'mode': 'adaptive', 'max_attempts': 3},
+    max_pool_connections=10,
+    connect_timeout=2
+)
+
 # Initialize all required AWS service clients
-s3 = boto3.client('s3')           # For accessing S3 bucket and objects
-textract = boto3.client('textract')  # For extracting text from receipt images
-dynamodb = boto3.resource('dynamodb')  # For database operations
-ses = boto3.client('ses')         # For sending email notifications
+s3 = boto3.client('s3', config=BOTO_CONFIG)              # For accessing S3 bucket and objects
+textract = boto3.client('textract', config=TEXTRACT_CONFIG)  # For extracting text from receipt images
+dynamodb = boto3.client('dynamodb', config=BOTO_CONFIG)  # For database operations
+ses = boto3.client('ses', config=BOTO_CONFIG)            # For sending email notifications
+sqs = boto3.client('sqs', config=BOTO_CONFIG)            # For queueing email notifications
 
 # ==========================================
 # ENVIRONMENT VARIABLES CONFIGURATION
@@ -22,70 +53,443 @@ ses = boto3.client('ses')         # For sending email notifications
 DYNAMODB_TABLE = os.environ.get('DYNAMODB_TABLE', 'Table_name')  # DynamoDB table name
 SES_SENDER_EMAIL = os.environ.get('SES_SENDER_EMAIL', 'sender_email')  # Verified sender email
 SES_RECIPIENT_EMAIL = os.environ.get('SES_RECIPIENT_EMAIL', 'receiver_email')  # Email to receive notifications
+SES_TEMPLATE_NAME = os.environ.get('SES_TEMPLATE_NAME', 'ReceiptNotice')  # SES email template (email_template.json)
+RECEIPT_PREFIX = os.environ.get('RECEIPT_PREFIX', '')  # Optional: only process keys under this prefix
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()  # Set to DEBUG to log the extracted receipt data
+
+# Optional: SQS queue drained by mailer_handler
+# When set, emails are queued instead of being sent while processing receipts
+MAIL_QUEUE_URL = os.environ.get('MAIL_QUEUE_URL', '')
+
+# Optional: SNS topic and IAM role used by asynchronous Textract jobs
+# When set, multi-page documents are analyzed asynchronously and the results
+# are handled by textract_completion_handler once Textract publishes to SNS
+TEXTRACT_SNS_TOPIC_ARN = os.environ.get('TEXTRACT_SNS_TOPIC_ARN', '')  # Job completion topic
+TEXTRACT_SNS_ROLE_ARN = os.environ.get('TEXTRACT_SNS_ROLE_ARN', '')    # Role Textract uses to publish
+
+# Number of receipts sent to Textract at the same time within one batch
+TEXTRACT_MAX_WORKERS = 10
+
+# Number of notification emails sent at the same time (without a mail queue)
+EMAIL_MAX_WORKERS = 10
+
+# Maximum number of items accepted by one DynamoDB BatchWriteItem call
+DYNAMODB_BATCH_SIZE = 25
+
+# How many times a BatchWriteItem call is made for the same chunk before giving up
+DYNAMODB_MAX_ATTEMPTS = 5
+
+# How many times a failed SQS mail queue entry is sent before giving up
+SQS_MAX_ATTEMPTS = 3
+
+# Crockford base32 alphabet used to encode receipt IDs (ULID format)
+ULID_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+# Largest file sent to Textract as raw bytes instead of an S3 reference
+TEXTRACT_MAX_BYTES = 5 * 1024 * 1024
+
+# File types Textract can analyze - anything else in the bucket is ignored
+RECEIPT_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.pdf', '.tif', '.tiff')
+
+# File types that can contain more than one page
+MULTI_PAGE_EXTENSIONS = ('.pdf', '.tif', '.tiff')
+
+# ==========================================
+# TEXTRACT FIELD MAPPINGS
+# ==========================================
+# Map Textract field types to the keys used in our receipt data
+SUMMARY_FIELD_KEYS = {
+    'TOTAL': 'total',
+    'INVOICE_RECEIPT_DATE': 'date',
+    'VENDOR_NAME': 'vendor'
+}
+LINE_ITEM_FIELD_KEYS = {
+    'ITEM': 'name',
+    'PRICE': 'price',
+    'QUANTITY': 'quantity'
+}
+
+# ==========================================
+# JSON ENCODING
+# ==========================================
+# One compact encoder (no spaces, UTF-8 kept as is) used for every message,
+# email and response body, so SQS, SES and CloudWatch payloads are smaller
+JSON_ENCODER = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+json_dumps = JSON_ENCODER.encode
+
+# Response returned when a batch is processed without errors
+SUCCESS_RESPONSE = {
+    'statusCode': 200,
+    'body': json_dumps('Receipt processed successfully!')
+}
+
+# Response returned when the event contains no receipt files
+SKIPPED_RESPONSE = {
+    'statusCode': 200,
+    'body': json_dumps('Skipped: no receipt files in event')
+}
+
+# ==========================================
+# LOGGING CONFIGURATION
+# ==========================================
+# Lambda sends log records to CloudWatch through the root logger's handler
+# The level is set on this module's logger only, so LOG_LEVEL=DEBUG does not
+# also turn on botocore's wire logs (which include the receipt image bytes)
+# Messages are only formatted when their level is enabled
+logger = logging.getLogger(__name__)
+try:
+    logger.setLevel(LOG_LEVEL)
+except ValueError:
+    logger.setLevel(logging.INFO)
+    logger.warning("Unknown LOG_LEVEL %s, using INFO", LOG_LEVEL)
+
+# ==========================================
+# REUSABLE RESOURCES (WARM-START CACHE)
+# ==========================================
+# Anything created at module level survives between warm invocations,
+# so build these once during Lambda init instead of on every receipt
+SES_DEST = {'ToAddresses': [SES_RECIPIENT_EMAIL]}        # Email recipients
+
+# Operations used by this function, per client
+# botocore loads each operation's model the first time it is called
+WARMUP_OPERATIONS = {
+    s3: ['GetObject'],
+    textract: ['AnalyzeExpense', 'StartExpenseAnalysis', 'GetExpenseAnalysis'],
+    dynamodb: ['BatchWriteItem', 'PutItem'],
+    ses: ['SendTemplatedEmail', 'SendBulkTemplatedEmail'],
+    sqs: ['SendMessageBatch']
+}
+
+def warm_up():
+    """
+    Load the operation models during Lambda init instead of in the first
+    invocation, which is the one a user is waiting for
+    """
+    for client, operations in WARMUP_OPERATIONS.items():
+        for operation in operations:
+            client.meta.service_model.operation_model(operation)
+
+warm_up()
 
 def lambda_handler(event, context):
     """
     Main Lambda function handler - This is the entry point when Lambda is triggered
     
     Args:
-        event: Contains information about the S3 event that triggered this function
+        event: Either an S3 event or an SQS batch of S3 event notifications
         context: Lambda runtime information (not used in this function)
     
     Returns:
-        Dictionary with statusCode and response body
+        For SQS events, the batchItemFailures of the messages to retry
+        Otherwise, dictionary with statusCode and response body
     """
+    from_sqs = False
+
     try:
+        # With an SQS trigger, failed receipts are reported per message so that
+        # SQS only retries those (requires ReportBatchItemFailures)
+        from_sqs = bool(event['Records']) and event['Records'][0].get('eventSource') == 'aws:sqs'
+
         # ==========================================
         # EXTRACT S3 EVENT INFORMATION
         # ==========================================
-        # When a file is uploaded to S3, it triggers this Lambda function
-        # The event contains details about which bucket and file triggered it
-        bucket = event['Records'][0]['s3']['bucket']['name']  # S3 bucket name
-        
-        # URL decode the key to handle spaces and special characters in filenames
-        # Example: "my%20receipt.jpg" becomes "my receipt.jpg"
-        key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'])
-
-        print(f"Processing receipt from {bucket}/{key}")
+        # Collect every uploaded file in this batch as (message ID, bucket, key, size)
+        s3_objects, failed_message_ids = get_s3_objects(event)
+        if not s3_objects and not failed_message_ids:
+            return {'batchItemFailures': []} if from_sqs else SKIPPED_RESPONSE
+        logger.info("Processing %s receipt(s)", len(s3_objects))
 
         # ==========================================
-        # VERIFY S3 OBJECT EXISTS
+        # MAIN PROCESSING PIPELINE
         # ==========================================
-        # Before processing, make sure the file actually exists and is accessible
+        # Step 1: Use AWS Textract to extract text and data from the receipt images
+        # Textract calls are network-bound, so run them concurrently across the batch
+        with ThreadPoolExecutor(max_workers=TEXTRACT_MAX_WORKERS) as executor:
+            futures = [
+                (s3_object, executor.submit(process_s3_object, *s3_object[1:]))
+                for s3_object in s3_objects
+            ]
+
+        # A failed receipt only fails its own message - the rest of the batch
+        # is still stored instead of being thrown away with it
+        processed = []
+        for (message_id, bucket, key, _), future in futures:
+            try:
+                receipt_data = future.result()
+            except Exception as e:
+                logger.error("Error processing receipt %s/%s: %s", bucket, key, e)
+                failed_message_ids.append(message_id)
+                continue
+            if receipt_data:
+                processed.append((message_id, receipt_data))
+
+        # A message that is retried is processed again in full, so receipts
+        # from a failed message are not stored now (avoids duplicates)
+        processed = [
+            (message_id, receipt_data) for message_id, receipt_data in processed
+            if message_id is None or message_id not in failed_message_ids
+        ]
+
+        # Step 2 and 3: Store the receipts in DynamoDB and send notifications
+        # Only the messages whose receipts were not written are retried;
+        # retrying a stored receipt would store it again under a new ID
         try:
-            s3.head_object(Bucket=bucket, Key=key)  # Check if object exists
-            print(f"Object verification successful: {bucket}/{key}")
+            failed_receipt_ids = store_and_notify([receipt_data for _, receipt_data in processed])
         except Exception as e:
-            print(f"Object verification failed: {str(e)}")
-            raise Exception(f"Unable to access object {key} in bucket {bucket}: {str(e)}")
-
-        # ==========================================
-        # MAIN PROCESSING PIPELINE
-        # ==========================================
-        # Step 1: Use AWS Textract to extract text and data from the receipt image
-        receipt_data = process_receipt_with_textract(bucket, key)
+            logger.error("Error storing receipts: %s", e)
+            failed_receipt_ids = [receipt_data['receipt_id'] for _, receipt_data in processed]
+        failed_message_ids.extend(
+            message_id for message_id, receipt_data in processed
+            if receipt_data['receipt_id'] in failed_receipt_ids
+        )
 
-        # Step 2: Save the extracted data to DynamoDB for permanent storage
-        store_receipt_in_dynamodb(receipt_data, bucket, key)
+        if from_sqs:
+            return {
+                'batchItemFailures': [
+                    {'itemIdentifier': message_id}
+                    for message_id in dict.fromkeys(failed_message_ids)
+                ]
+            }
 
-        # Step 3: Send an email notification with the processed receipt details
-        send_email_notification(receipt_data)
+        if failed_message_ids:
+            return {
+                'statusCode': 500,
+                'body': json_dumps(f'Error: {len(failed_message_ids)} receipt(s) failed')
+            }
 
         # Return success response
-        return {
-            'statusCode': 200,
-            'body': json.dumps('Receipt processed successfully!')
-        }
+        return SUCCESS_RESPONSE
         
     except Exception as e:
         # Log any errors that occur during processing
-        print(f"Error processing receipt: {str(e)}")
+        logger.error("Error processing receipt: %s", e)
+        if from_sqs:
+            # Returning normally would delete the whole batch - raise so
+            # SQS makes every message visible again instead
+            raise
         return {
             'statusCode': 500,
-            'body': json.dumps(f'Error: {str(e)}')
+            'body': json_dumps(f'Error: {str(e)}')
         }
 
-def process_receipt_with_textract(bucket, key):
+def get_s3_objects(event):
+    """
+    Collect the bucket and key of every uploaded file in the event
+    
+    The function can be triggered directly by S3, or through an SQS queue
+    that receives the S3 notifications (so several uploads arrive together)
+    
+    Args:
+        event: S3 event or SQS event wrapping S3 event notifications
+    
+    Returns:
+        Tuple of:
+        - list of (message ID, bucket, key, size) tuples for receipt files only;
+          the message ID is the SQS messageId, or None for direct S3 events
+        - list of SQS message IDs that are not valid S3 notifications
+    """
+    s3_objects = []
+    invalid_message_ids = []
+    for record in event['Records']:
+        if record.get('eventSource') != 'aws:sqs':
+            s3_objects.extend(get_receipt_objects([record], None))
+            continue
+
+        # SQS message body is the original S3 notification as JSON
+        # S3 test events sent when configuring the bucket have no Records
+        # A malformed message only fails itself, not the rest of the batch
+        try:
+            body = json.loads(record['body'])
+            s3_objects.extend(get_receipt_objects(body.get('Records', []), record['messageId']))
+        except (ValueError, AttributeError, KeyError, TypeError) as e:
+            logger.error("Invalid S3 notification in message %s: %s", record['messageId'], e)
+            invalid_message_ids.append(record['messageId'])
+
+    return s3_objects, invalid_message_ids
+
+def get_receipt_objects(s3_records, message_id):
+    """
+    Read bucket, key and size from S3 event records, skipping non-receipt files
+    
+    Args:
+        s3_records: S3 event notification records
+        message_id: SQS messageId the records came from, or None
+    
+    Returns:
+        List of (message ID, bucket, key, size) tuples; size is None
+        when the record doesn't include it
+    """
+    s3_objects = []
+    for record in s3_records:
+        bucket = record['s3']['bucket']['name']  # S3 bucket name
+
+        # URL decode the key to handle spaces and special characters in filenames
+        # Example: "my%20receipt.jpg" becomes "my receipt.jpg"
+        key = urllib.parse.unquote_plus(record['s3']['object']['key'])
+
+        # Skip files that are not receipts before making any AWS call,
+        # so unrelated uploads don't cost a Textract request
+        if not key.startswith(RECEIPT_PREFIX) or not key.lower().endswith(RECEIPT_EXTENSIONS):
+            logger.info("Skipping non-receipt file %s/%s", bucket, key)
+            continue
+
+        # Object size in bytes, used to decide how to send the file to Textract
+        size = record['s3']['object'].get('size')
+
+        logger.info("Processing receipt from %s/%s", bucket, key)
+        s3_objects.append((message_id, bucket, key, size))
+
+    return s3_objects
+
+def process_s3_object(bucket, key, size=None):
+    """
+    Run Textract on one uploaded file
+    
+    Multi-page documents are handed to an asynchronous Textract job
+    so this function does not wait (and get billed) while they are analyzed
+    
+    Args:
+        bucket: S3 bucket name containing the receipt
+        key: S3 object key (filename) of the receipt
+        size: Object size in bytes from the S3 event, or None if unknown
+    
+    Returns:
+        Extracted receipt data, or None when an asynchronous job was started
+    """
+    if use_async_textract(key):
+        start_textract_expense_analysis(bucket, key)
+        return None
+    return process_receipt_with_textract(bucket, key, size)
+
+def textract_completion_handler(event, context):
+    """
+    Lambda handler for asynchronous Textract jobs - subscribe it to the SNS topic
+    set in TEXTRACT_SNS_TOPIC_ARN
+    
+    Args:
+        event: SNS event containing Textract job completion messages
+        context: Lambda runtime information (not used in this function)
+    
+    Returns:
+        Dictionary with statusCode and response body
+    
+    Raises:
+        Exception: if a receipt could not be processed, so the event is retried
+    """
+    try:
+        receipts = []
+        for record in event['Records']:
+            # ==========================================
+            # READ TEXTRACT JOB NOTIFICATION
+            # ==========================================
+            message = json.loads(record['Sns']['Message'])
+            job_id = message['JobId']
+            bucket = message['DocumentLocation']['S3Bucket']
+            key = message['DocumentLocation']['S3ObjectName']
+
+            if message['Status'] != 'SUCCEEDED':
+                logger.warning("Textract job %s for %s/%s finished with status %s", job_id, bucket, key, message['Status'])
+                continue
+
+            logger.info("Collecting Textract results for %s/%s (job %s)", bucket, key, job_id)
+            # Result pages are parsed one at a time as they are fetched
+            expense_documents = get_textract_expense_documents(job_id)
+            receipts.append(build_receipt_data(expense_documents, bucket, key))
+
+        # Store the receipts in DynamoDB and send notifications
+        failed_receipt_ids = store_and_notify(receipts)
+        if failed_receipt_ids:
+            raise Exception(f"{len(failed_receipt_ids)} receipt(s) could not be stored")
+
+        return SUCCESS_RESPONSE
+
+    except Exception as e:
+        # SNS invokes this function asynchronously, so a returned error
+        # response counts as success - raise so Lambda retries the event
+        # and then hands it to the on-failure destination / DLQ
+        logger.error("Error processing receipt: %s", e)
+        raise
+
+def use_async_textract(key):
+    """
+    Decide whether a file should be analyzed with an asynchronous Textract job
+    
+    Args:
+        key: S3 object key (filename) of the receipt
+    
+    Returns:
+        True for multi-page file types when the SNS topic and role are configured
+    """
+    return (
+        bool(TEXTRACT_SNS_TOPIC_ARN and TEXTRACT_SNS_ROLE_ARN)
+        and key.lower().endswith(MULTI_PAGE_EXTENSIONS)
+    )
+
+def start_textract_expense_analysis(bucket, key):
+    """
+    Start an asynchronous Textract expense analysis job
+    Textract publishes to the SNS topic when the job finishes
+    
+    Args:
+        bucket: S3 bucket name containing the receipt
+        key: S3 object key (filename) of the receipt
+    
+    Returns:
+        Textract job ID
+    """
+    try:
+        response = textract.start_expense_analysis(
+            DocumentLocation={
+                'S3Object': {
+                    'Bucket': bucket,
+                    'Name': key
+                }
+            },
+            NotificationChannel={
+                'SNSTopicArn': TEXTRACT_SNS_TOPIC_ARN,
+                'RoleArn': TEXTRACT_SNS_ROLE_ARN
+            }
+        )
+        logger.info("Started Textract job %s for %s/%s", response['JobId'], bucket, key)
+        return response['JobId']
+
+    except Exception as e:
+        logger.error("Textract start_expense_analysis call failed: %s", e)
+        raise
+
+def get_textract_expense_documents(job_id):
+    """
+    Retrieve the results of a finished asynchronous Textract job
+    
+    Large documents are returned in several pages linked by NextToken.
+    Pages are fetched lazily, so only one page of a large multi-page
+    result is held in memory at a time
+    
+    Args:
+        job_id: Textract job ID from the SNS notification
+    
+    Yields:
+        ExpenseDocuments from each result page, in order
+    """
+    try:
+        next_token = None
+        while True:
+            if next_token:
+                page = textract.get_expense_analysis(JobId=job_id, NextToken=next_token)
+            else:
+                page = textract.get_expense_analysis(JobId=job_id)
+
+            yield from page.get('ExpenseDocuments', [])
+
+            next_token = page.get('NextToken')
+            if not next_token:
+                break
+
+    except Exception as e:
+        logger.error("Textract get_expense_analysis call failed: %s", e)
+        raise
+
+def process_receipt_with_textract(bucket, key, size=None):
     """
     Process receipt image using AWS Textract's AnalyzeExpense operation
     This is specifically designed for receipts and invoices
@@ -93,43 +497,108 @@ def process_receipt_with_textract(bucket, key):
     Args:
         bucket: S3 bucket name containing the receipt
         key: S3 object key (filename) of the receipt
+        size: Object size in bytes from the S3 event, or None if unknown
     
     Returns:
         Dictionary containing extracted receipt data
     """
+    # ==========================================
+    # READ RECEIPT FROM S3
+    # ==========================================
+    # Small files are downloaded once here and sent to Textract as bytes,
+    # so Textract doesn't have to fetch the object from S3 itself.
+    # Files too large to send inline are left for Textract to read from S3,
+    # without downloading them first.
+    document = {
+        'S3Object': {
+            'Bucket': bucket,
+            'Name': key
+        }
+    }
+    if size is None or size <= TEXTRACT_MAX_BYTES:
+        try:
+            s3_object = s3.get_object(Bucket=bucket, Key=key)
+        except Exception as e:
+            logger.error("Object verification failed: %s", e)
+            raise Exception(f"Unable to access object {key} in bucket {bucket}: {str(e)}")
+
+        # The size was not in the event, so only the response tells
+        if s3_object['ContentLength'] <= TEXTRACT_MAX_BYTES:
+            document = {'Bytes': s3_object['Body'].read()}
+        else:
+            s3_object['Body'].close()
+
     try:
-        print(f"Calling Textract analyze_expense for {bucket}/{key}")
+        logger.info("Calling Textract analyze_expense for %s/%s", bucket, key)
         
         # ==========================================
         # CALL AWS TEXTRACT SERVICE
         # ==========================================
         # analyze_expense is specifically designed for receipts and invoices
         # It can automatically identify fields like total, date, vendor, items
-        response = textract.analyze_expense(
-            Document={
-                'S3Object': {
-                    'Bucket': bucket,
-                    'Name': key
-                }
-            }
-        )
-        print("Textract analyze_expense call successful")
-        
+        response = textract.analyze_expense(Document=document)
+        logger.info("Textract analyze_expense call successful")
+
+    except textract.exceptions.InvalidS3ObjectException as e:
+        # Large files are read by Textract itself, so an unreadable
+        # object surfaces here
+        logger.error("Object verification failed: %s", e)
+        raise Exception(f"Unable to access object {key} in bucket {bucket}: {str(e)}")
     except Exception as e:
-        print(f"Textract analyze_expense call failed: {str(e)}")
+        logger.error("Textract analyze_expense call failed: %s", e)
         raise
 
+    return build_receipt_data(response.get('ExpenseDocuments', []), bucket, key)
+
+def generate_receipt_id(timestamp):
+    """
+    Generate a ULID: 48-bit millisecond timestamp + 80 random bits,
+    encoded as 26 Crockford base32 characters
+    
+    IDs sort by creation time, so receipts can be range-queried by when
+    they were processed, and they are shorter than a UUID string
+    
+    Args:
+        timestamp: Creation time in seconds since the epoch (time.time())
+    
+    Returns:
+        26-character receipt ID
+    """
+    value = (int(timestamp * 1000) << 80) | int.from_bytes(os.urandom(10), 'big')
+
+    chars = []
+    for _ in range(26):
+        chars.append(ULID_ALPHABET[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+def build_receipt_data(expense_documents, bucket, key):
+    """
+    Convert Textract expense documents into our receipt structure
+    
+    Args:
+        expense_documents: ExpenseDocuments from analyze_expense or get_expense_analysis
+        bucket: S3 bucket name containing the receipt
+        key: S3 object key (filename) of the receipt
+    
+    Returns:
+        Dictionary containing extracted receipt data
+    """
     # ==========================================
     # INITIALIZE RECEIPT DATA STRUCTURE
     # ==========================================
-    # Generate a unique ID for this receipt using UUID
-    receipt_id = str(uuid.uuid4())
+    # Read the clock once and derive both the ID and the default date from it
+    now = time.time()
+    today = time.gmtime(now)
+
+    # Generate a unique, time-ordered ID for this receipt
+    receipt_id = generate_receipt_id(now)
 
     # Create a standardized data structure for the receipt
     # Set default values in case Textract can't extract certain fields
     receipt_data = {
         'receipt_id': receipt_id,
-        'date': datetime.now().strftime('%Y-%m-%d'),  # Default to today's date
+        'date': f"{today.tm_year:04d}-{today.tm_mon:02d}-{today.tm_mday:02d}",  # Default to today's date (UTC)
         'vendor': 'Unknown',  # Default vendor name
         'total': '0.00',      # Default total amount
         'items': [],          # List to store individual items
@@ -139,117 +608,364 @@ def process_receipt_with_textract(bucket, key):
     # ==========================================
     # EXTRACT DATA FROM TEXTRACT RESPONSE
     # ==========================================
-    # Textract response contains ExpenseDocuments array
-    if 'ExpenseDocuments' in response and response['ExpenseDocuments']:
-        expense_doc = response['ExpenseDocuments'][0]  # Get first (and usually only) document
+    # Only the first receipt in the file is used (usually the only one)
+    # A receipt spread over several pages shares the same ExpenseIndex
+    receipt_index = None
+    for expense_doc in expense_documents:
+        if receipt_index is None:
+            receipt_index = expense_doc.get('ExpenseIndex')
+        elif expense_doc.get('ExpenseIndex') != receipt_index:
+            continue
 
         # ==========================================
         # PROCESS SUMMARY FIELDS
         # ==========================================
         # Summary fields contain high-level information like total, date, vendor
-        if 'SummaryFields' in expense_doc:
-            for field in expense_doc['SummaryFields']:
-                # Extract field type and value from Textract response
-                field_type = field.get('Type', {}).get('Text', '')
-                value = field.get('ValueDetection', {}).get('Text', '')
-
-                # Map Textract field types to our data structure
-                if field_type == 'TOTAL':
-                    receipt_data['total'] = value
-                elif field_type == 'INVOICE_RECEIPT_DATE':
-                    # Try to use the extracted date, fall back to default if parsing fails
-                    try:
-                        receipt_data['date'] = value
-                    except:
-                        # Keep the default date if parsing fails
-                        pass
-                elif field_type == 'VENDOR_NAME':
-                    receipt_data['vendor'] = value
+        for field in expense_doc.get('SummaryFields', []):
+            try:
+                receipt_key = SUMMARY_FIELD_KEYS.get(field['Type']['Text'])
+                value = field['ValueDetection']['Text']
+                # An empty value keeps the default - date is the table's sort
+                # key and DynamoDB rejects empty key attributes
+                if receipt_key and value:
+                    receipt_data[receipt_key] = value
+            except KeyError:
+                # Field without a type or value - keep the default
+                pass
 
         # ==========================================
         # PROCESS LINE ITEMS
         # ==========================================
         # Line items contain individual products/services on the receipt
-        if 'LineItemGroups' in expense_doc:
-            for group in expense_doc['LineItemGroups']:
-                if 'LineItems' in group:
-                    for line_item in group['LineItems']:
-                        item = {}  # Dictionary to store individual item data
-                        
-                        # Extract fields for each line item
-                        for field in line_item.get('LineItemExpenseFields', []):
-                            field_type = field.get('Type', {}).get('Text', '')
-                            value = field.get('ValueDetection', {}).get('Text', '')
-
-                            # Map field types to item properties
-                            if field_type == 'ITEM':
-                                item['name'] = value
-                            elif field_type == 'PRICE':
-                                item['price'] = value
-                            elif field_type == 'QUANTITY':
-                                item['quantity'] = value
-
-                        # Only add items that have at least a name
-                        if 'name' in item:
-                            receipt_data['items'].append(item)
+        for group in expense_doc.get('LineItemGroups', []):
+            for line_item in group.get('LineItems', []):
+                item = {}  # Dictionary to store individual item data
+
+                # Extract fields for each line item
+                for field in line_item.get('LineItemExpenseFields', []):
+                    try:
+                        item_key = LINE_ITEM_FIELD_KEYS.get(field['Type']['Text'])
+                        if item_key:
+                            item[item_key] = field['ValueDetection']['Text']
+                    except KeyError:
+                        pass
+
+                # Only add items that have at least a name
+                if 'name' in item:
+                    receipt_data['items'].append(item)
 
     # Log the extracted data for debugging
-    print(f"Extracted receipt data: {json.dumps(receipt_data)}")
+    logger.debug("Extracted receipt data: %s", receipt_data)
     return receipt_data
 
-def store_receipt_in_dynamodb(receipt_data, bucket, key):
+def store_receipt_in_dynamodb(receipts):
     """
     Store the extracted receipt data in DynamoDB table
     
+    Receipts that could not be written are returned rather than raised,
+    so the caller can retry just those - the rest of the batch is already
+    stored and must not be written again
+    
     Args:
-        receipt_data: Dictionary containing extracted receipt information
-        bucket: S3 bucket name (for reference)
-        key: S3 object key (for reference)
+        receipts: List of dictionaries containing extracted receipt information
+    
+    Returns:
+        List of receipt IDs that were not stored
     """
+    failed_receipt_ids = []
     try:
         # ==========================================
-        # GET DYNAMODB TABLE REFERENCE
-        # ==========================================
-        table = dynamodb.Table(DYNAMODB_TABLE)
-
-        # ==========================================
-        # PREPARE ITEMS DATA FOR DYNAMODB
+        # CREATE DYNAMODB ITEMS
         # ==========================================
-        # Convert items list to a format that DynamoDB can store
-        # Ensure all items have required fields with default values
-        items_for_db = []
-        for item in receipt_data['items']:
-            items_for_db.append({
-                'name': item.get('name', 'Unknown Item'),
-                'price': item.get('price', '0.00'),
-                'quantity': item.get('quantity', '1')
-            })
+        # Items are written in DynamoDB's typed format ({'S': ...}, {'L': ...})
+        # directly, so no serializer has to walk every attribute on each write
+        processed_timestamp = datetime.now().isoformat()  # When this was processed
+        write_requests = []
+        for receipt_data in receipts:
+            # ==========================================
+            # PREPARE ITEMS DATA FOR DYNAMODB
+            # ==========================================
+            # Convert items list to a format that DynamoDB can store
+            # Ensure all items have required fields with default values
+            items_for_db = [
+                {'M': {
+                    'name': {'S': item.get('name', 'Unknown Item')},
+                    'price': {'S': item.get('price', '0.00')},
+                    'quantity': {'S': item.get('quantity', '1')}
+                }}
+                for item in receipt_data['items']
+            ]
 
-        # ==========================================
-        # CREATE DYNAMODB ITEM
-        # ==========================================
-        # Structure the data according to our DynamoDB table schema
-        # receipt_id = partition key, date = sort key
-        db_item = {
-            'receipt_id': receipt_data['receipt_id'],    # Partition key
-            'date': receipt_data['date'],                # Sort key
-            'vendor': receipt_data['vendor'],            # Vendor name
-            'total': receipt_data['total'],              # Total amount
-            'items': items_for_db,                       # List of items
-            's3_path': receipt_data['s3_path'],          # Reference to original file
-            'processed_timestamp': datetime.now().isoformat()  # When this was processed
-        }
+            # Structure the data according to our DynamoDB table schema
+            # receipt_id = partition key, date = sort key
+            db_item = {
+                'receipt_id': {'S': receipt_data['receipt_id']},  # Partition key
+                'date': {'S': receipt_data['date']},              # Sort key
+                'vendor': {'S': receipt_data['vendor']},          # Vendor name
+                'total': {'S': receipt_data['total']},            # Total amount
+                'items': {'L': items_for_db},                     # List of items
+                's3_path': {'S': receipt_data['s3_path']},        # Reference to original file
+                'processed_timestamp': {'S': processed_timestamp}
+            }
+            write_requests.append({'PutRequest': {'Item': db_item}})
 
         # ==========================================
         # INSERT INTO DYNAMODB
         # ==========================================
-        table.put_item(Item=db_item)
-        print(f"Receipt data stored in DynamoDB: {receipt_data['receipt_id']}")
+        # BatchWriteItem accepts up to 25 items per call
+        for start in range(0, len(write_requests), DYNAMODB_BATCH_SIZE):
+            request_items = {DYNAMODB_TABLE: write_requests[start:start + DYNAMODB_BATCH_SIZE]}
+
+            # Items DynamoDB could not write (e.g. throttling) are returned
+            # in UnprocessedItems instead of raising, so send them again
+            # with exponential backoff and jitter until they are all written
+            try:
+                for attempt in range(DYNAMODB_MAX_ATTEMPTS):
+                    if attempt:
+                        time.sleep(2 ** attempt * 0.05 + random.uniform(0, 0.05))
+
+                    response = dynamodb.batch_write_item(RequestItems=request_items)
+                    request_items = response.get('UnprocessedItems')
+                    if not request_items:
+                        break
+                else:
+                    logger.error("%s receipt(s) still unprocessed after %s attempts",
+                                 len(request_items[DYNAMODB_TABLE]), DYNAMODB_MAX_ATTEMPTS)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ValidationException':
+                    logger.error("Error storing data in DynamoDB: %s", e)
+                else:
+                    # One invalid item (e.g. over 400 KB) rejects the whole
+                    # batch - write the chunk one item at a time so only
+                    # the invalid receipt fails
+                    logger.warning("Batch write rejected, writing items one by one: %s", e)
+                    remaining = put_items_individually(request_items[DYNAMODB_TABLE])
+                    request_items = {DYNAMODB_TABLE: remaining} if remaining else None
+            except Exception as e:
+                logger.error("Error storing data in DynamoDB: %s", e)
+
+            # Whatever is left in request_items was not written
+            if request_items:
+                failed_receipt_ids.extend(
+                    write_request['PutRequest']['Item']['receipt_id']['S']
+                    for write_request in request_items[DYNAMODB_TABLE]
+                )
+
+        logger.info("Receipt data stored in DynamoDB: %s",
+                    [r['receipt_id'] for r in receipts if r['receipt_id'] not in failed_receipt_ids])
         
     except Exception as e:
-        print(f"Error storing data in DynamoDB: {str(e)}")
+        logger.error("Error storing data in DynamoDB: %s", e)
         raise
 
+    return failed_receipt_ids
+
+def put_items_individually(write_requests):
+    """
+    Write items with one put_item call each
+    
+    Args:
+        write_requests: BatchWriteItem PutRequests to write
+    
+    Returns:
+        List of the write requests that failed
+    """
+    failed_requests = []
+    for write_request in write_requests:
+        item = write_request['PutRequest']['Item']
+        try:
+            dynamodb.put_item(TableName=DYNAMODB_TABLE, Item=item)
+        except Exception as e:
+            logger.error("Error storing receipt %s in DynamoDB: %s", item['receipt_id']['S'], e)
+            failed_requests.append(write_request)
+    return failed_requests
+
+def store_and_notify(receipts):
+    """
+    Save processed receipts to DynamoDB and send an email for each one
+    
+    Args:
+        receipts: List of dictionaries containing extracted receipt information
+    
+    Returns:
+        List of receipt IDs that were not stored (and got no email)
+    """
+    if not receipts:
+        return []
+
+    # Save the extracted data to DynamoDB for permanent storage
+    failed_receipt_ids = store_receipt_in_dynamodb(receipts)
+
+    # Send an email notification with the processed receipt details
+    # The email says the receipt was stored, so only stored receipts get one
+    stored_receipts = [r for r in receipts if r['receipt_id'] not in failed_receipt_ids]
+    if stored_receipts:
+        send_email_notifications(stored_receipts)
+
+    return failed_receipt_ids
+
+def send_email_notifications(receipts):
+    """
+    Send an email notification for each processed receipt
+    If a mail queue is configured, hand the emails to mailer_handler instead
+    
+    Args:
+        receipts: List of dictionaries containing extracted receipt information
+    """
+    if MAIL_QUEUE_URL:
+        queue_email_notifications(receipts)
+    else:
+        # Emails are independent network calls, so send them concurrently
+        with ThreadPoolExecutor(max_workers=EMAIL_MAX_WORKERS) as executor:
+            list(executor.map(send_email_notification, receipts))
+
+def queue_email_notifications(receipts):
+    """
+    Put email notifications on the SQS mail queue for mailer_handler to send
+    
+    Args:
+        receipts: List of dictionaries containing extracted receipt information
+    """
+    try:
+        failed_count = 0
+
+        # send_message_batch accepts at most 10 messages per call
+        for start in range(0, len(receipts), 10):
+            # The receipt ID (a ULID) is a valid batch entry ID and
+            # identifies the receipt when an entry fails
+            entries = [
+                {
+                    'Id': receipt_data['receipt_id'],
+                    'MessageBody': json_dumps({'receipt': receipt_data})
+                }
+                for receipt_data in receipts[start:start + 10]
+            ]
+
+            # Failed entries are listed in the response instead of raising
+            # Resend the ones that failed on the SQS side; entries rejected
+            # because of the request itself (SenderFault) would fail again
+            failed = []
+            for attempt in range(SQS_MAX_ATTEMPTS):
+                response = sqs.send_message_batch(QueueUrl=MAIL_QUEUE_URL, Entries=entries)
+                retry_ids = set()
+                for entry in response.get('Failed', []):
+                    if entry['SenderFault'] or attempt == SQS_MAX_ATTEMPTS - 1:
+                        failed.append(entry)
+                    else:
+                        retry_ids.add(entry['Id'])
+                if not retry_ids:
+                    break
+                entries = [entry for entry in entries if entry['Id'] in retry_ids]
+
+            for entry in failed:
+                logger.error("Error queueing email notification for receipt %s: %s %s",
+                             entry['Id'], entry['Code'], entry.get('Message', ''))
+            failed_count += len(failed)
+
+        logger.info("Queued %s email notification(s)", len(receipts) - failed_count)
+
+    except Exception as e:
+        logger.error("Error queueing email notifications: %s", e)
+        # Continue execution even if email fails - don't let email errors stop the process
+        logger.warning("Continuing execution despite email error")
+
+def mailer_handler(event, context):
+    """
+    Lambda handler that sends the queued email notifications - add the
+    MAIL_QUEUE_URL queue as its event source with ReportBatchItemFailures
+    
+    Args:
+        event: SQS event containing queued receipts
+        context: Lambda runtime information (not used in this function)
+    
+    Returns:
+        Dictionary listing the SQS messages whose email was not sent,
+        so only those are retried
+    """
+    failed_message_ids = []
+
+    # Pair each receipt with the SQS message it came from
+    messages = []
+    for record in event['Records']:
+        try:
+            messages.append((record['messageId'], json.loads(record['body'])['receipt']))
+        except (ValueError, KeyError) as e:
+            logger.error("Invalid mail queue message %s: %s", record['messageId'], e)
+            failed_message_ids.append(record['messageId'])
+
+    # ==========================================
+    # SEND EMAILS USING AWS SES TEMPLATE
+    # ==========================================
+    # One send_bulk_templated_email call covers up to 50 emails,
+    # each filled in with the data of its own receipt
+    for start in range(0, len(messages), 50):
+        chunk = messages[start:start + 50]
+        try:
+            response = ses.send_bulk_templated_email(
+                Source=SES_SENDER_EMAIL,  # Must be a verified email address in SES
+                Template=SES_TEMPLATE_NAME,
+                DefaultTemplateData=json_dumps(get_email_template_data({})),
+                Destinations=[
+                    {
+                        'Destination': SES_DEST,
+                        'ReplacementTemplateData': json_dumps(get_email_template_data(receipt_data))
+                    }
+                    for _, receipt_data in chunk
+                ]
+            )
+        except Exception as e:
+            logger.error("Error sending email notifications: %s", e)
+            failed_message_ids.extend(message_id for message_id, _ in chunk)
+            continue
+
+        # Status entries are in the same order as the destinations
+        for (message_id, receipt_data), status in zip(chunk, response['Status']):
+            if status['Status'] != 'Success':
+                logger.error("Error sending email notification for receipt %s: %s",
+                             receipt_data.get('receipt_id'), status.get('Error', status['Status']))
+                failed_message_ids.append(message_id)
+
+    logger.info("Sent %s email notification(s) to %s",
+                len(event['Records']) - len(failed_message_ids), SES_RECIPIENT_EMAIL)
+
+    return {
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]
+    }
+
+def get_email_template_data(receipt_data):
+    """
+    Build the values used to fill in the SES email template
+    
+    Values shown in the HTML body come from Textract (or the file name), so
+    they are HTML-escaped here and inserted unescaped ({{{...}}}) by the
+    template. The subject is plain text and gets the original values
+    
+    Args:
+        receipt_data: Dictionary containing extracted receipt information
+    
+    Returns:
+        Dictionary of template variables
+    """
+    vendor = receipt_data.get('vendor', 'Unknown')
+    total = receipt_data.get('total', '0.00')
+    return {
+        'subject_vendor': vendor,
+        'subject_total': total,
+        'receipt_id': escape(receipt_data.get('receipt_id', '')),
+        'vendor': escape(vendor),
+        'date': escape(receipt_data.get('date', '')),
+        'total': escape(total),
+        's3_path': escape(receipt_data.get('s3_path', '')),
+        'items': [
+            {
+                'name': escape(item.get('name', 'Unknown Item')),
+                'price': escape(item.get('price', 'N/A')),
+                'quantity': escape(item.get('quantity', '1'))
+            }
+            for item in receipt_data.get('items', [])
+        ]
+    }
+
 def send_email_notification(receipt_data):
     """
     Send an email notification with receipt processing results
@@ -259,67 +975,20 @@ def send_email_notification(receipt_data):
     """
     try:
         # ==========================================
-        # FORMAT ITEMS FOR EMAIL DISPLAY
-        # ==========================================
-        # Create HTML list of items for the email
-        items_html = ""
-        for item in receipt_data['items']:
-            name = item.get('name', 'Unknown Item')
-            price = item.get('price', 'N/A')
-            quantity = item.get('quantity', '1')
-            items_html += f"<li>{name} - ${price} x {quantity}</li>"
-
-        # Handle case where no items were detected
-        if not items_html:
-            items_html = "<li>No items detected</li>"
-
+        # SEND EMAIL USING AWS SES TEMPLATE
         # ==========================================
-        # CREATE HTML EMAIL BODY
-        # ==========================================
-        # Create a nicely formatted HTML email with all receipt details
-        html_body = f"""
-        <html>
-        <body>
-            <h2>📧 Receipt Processing Notification</h2>
-            <p><strong>Receipt ID:</strong> {receipt_data['receipt_id']}</p>
-            <p><strong>Vendor:</strong> {receipt_data['vendor']}</p>
-            <p><strong>Date:</strong> {receipt_data['date']}</p>
-            <p><strong>Total Amount:</strong> ${receipt_data['total']}</p>
-            <p><strong>S3 Location:</strong> {receipt_data['s3_path']}</p>
-
-            <h3>📋 Items:</h3>
-            <ul>
-                {items_html}
-            </ul>
-
-            <p>✅ The receipt has been processed and stored in DynamoDB.</p>
-        </body>
-        </html>
-        """
-
-        # ==========================================
-        # SEND EMAIL USING AWS SES
-        # ==========================================
-        ses.send_email(
+        # The HTML layout lives in the SES template (email_template.json),
+        # so only the receipt values are sent with each email
+        ses.send_templated_email(
             Source=SES_SENDER_EMAIL,  # Must be a verified email address in SES
-            Destination={
-                'ToAddresses': [SES_RECIPIENT_EMAIL]  # Can be a list of multiple recipients
-            },
-            Message={
-                'Subject': {
-                    'Data': f"Receipt Processed: {receipt_data['vendor']} - ${receipt_data['total']}"
-                },
-                'Body': {
-                    'Html': {
-                        'Data': html_body
-                    }
-                }
-            }
+            Destination=SES_DEST,     # Can be a list of multiple recipients
+            Template=SES_TEMPLATE_NAME,
+            TemplateData=json_dumps(get_email_template_data(receipt_data))
         )
 
-        print(f"Email notification sent to {SES_RECIPIENT_EMAIL}")
+        logger.info("Email notification sent to %s", SES_RECIPIENT_EMAIL)
         
     except Exception as e:
-        print(f"Error sending email notification: {str(e)}")
+        logger.error("Error sending email notification: %s", e)
         # Continue execution even if email fails - don't let email errors stop the process
-        print("Continuing execution despite email error")
\ No newline at end of file
+        logger.warning("Continuing execution despite email error")